@@ -1,17 +1,70 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, g, Response
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
-import json
+import orjson
 import os
 import hashlib
+import queue
+import atexit
+import functools
+import collections
+import datetime
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Route jsonify() and request.json through orjson
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# '/api/sessions/' and '/api/sessions' route the same way, without a redirect
+app.url_map.strict_slashes = False
 DB_PATH = 'stretching_coach.db'
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Applied to every connection; journal_mode=WAL is persistent and creates
+# stretching_coach.db-wal / stretching_coach.db-shm next to the database
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-64000',
+    # Fold the WAL back into the database every ~1000 pages (~4 MB) so it stays small
+    'PRAGMA wal_autocheckpoint=1000',
+    # Writers wait up to 5s for the lock taken by BEGIN IMMEDIATE instead of failing with SQLITE_BUSY
+    'PRAGMA busy_timeout=5000',
+)
+
+# Pool of open connections so SQLite keeps its page cache between requests
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+# Request headers that select the user (see _resolve_user_id); sent as Vary on
+# per-user responses so shared caches never serve one user's data to another
+USER_VARY_HEADERS = ('X-Telegram-User-Id', 'X-User-Id', 'Cookie')
+
+# Serialized GET /api/studios bodies per user as (studios version, bytes),
+# least recently used first; any studio write changes the version
+STUDIOS_RESPONSE_CACHE_SIZE = 10000
+_studios_response_cache = collections.OrderedDict()
 
 # Helper function to get user_id from request
 def get_user_id():
     """
-    Get user_id from Telegram WebApp init data or create anonymous user
+    Get user_id from Telegram WebApp init data or create anonymous user.
+    The result is kept on flask.g, so repeated calls in one request are free.
     """
+    user_id = g.get('user_id')
+    if user_id is None:
+        user_id = g.user_id = _resolve_user_id()
+    return user_id
+
+def _resolve_user_id():
     # Try to get from Telegram WebApp init data
     telegram_data = request.headers.get('X-Telegram-User-Id')
     if telegram_data:
@@ -31,13 +84,58 @@ def get_user_id():
         return f"web_{session_id}"
     else:
         # Create hash from IP (not perfect but works for demo)
-        return f"web_{hashlib.md5(ip.encode()).hexdigest()[:8]}"
+        return f"web_{_ip_to_hash(ip)}"
+
+@app.before_request
+def load_user_id():
+    # Resolved once per request; routes read g.user_id
+    g.user_id = _resolve_user_id()
+
+@functools.lru_cache(maxsize=4096)
+def _ip_to_hash(ip):
+    # Stays MD5 so existing anonymous users keep the same id (and their data)
+    return hashlib.md5(ip.encode()).hexdigest()[:8]
+
+# calculate_payment() as a SQL expression over the current training_sessions row
+# (used in UPDATE training_sessions ... SET and RETURNING)
+STORED_PAYMENT_SQL = '''
+    COALESCE((SELECT CASE WHEN training_sessions.attendee_count > st.start_count_from
+                          THEN st.minimum_payment
+                               + (training_sessions.attendee_count - st.start_count_from) * st.payment_per_client
+                          ELSE st.minimum_payment END
+              FROM studios st
+              WHERE st.id = training_sessions.studio_id AND st.user_id = training_sessions.user_id), 0)
+'''
+
+# Bump when _migrate_schema() gains a step; stored in PRAGMA user_version
+SCHEMA_VERSION = 4
 
 # Database initialization
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     c = conn.cursor()
     
+    # One integer check on startup; the version is re-read under the write
+    # lock so concurrent gunicorn workers only migrate once
+    if c.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        c.execute('BEGIN IMMEDIATE')
+        if c.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            _migrate_schema(c)
+            c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        c.execute('COMMIT')
+    
+    # Refresh planner statistics on every startup so they follow the data's growth;
+    # analysis_limit samples each index, keeping this cheap on large databases
+    c.execute('PRAGMA analysis_limit=1000')
+    c.execute('ANALYZE')
+    
+    # WAL lets readers run during writes; synchronous=NORMAL drops one fsync per commit
+    for pragma in CONNECTION_PRAGMAS:
+        c.execute(pragma)
+    conn.close()
+
+def _migrate_schema(c):
+    """Create or upgrade tables, triggers and indexes to SCHEMA_VERSION."""
     # Create tables with user_id for multi-user support
     c.execute('''CREATE TABLE IF NOT EXISTS studios
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -61,53 +159,342 @@ def init_db():
                   session_type TEXT NOT NULL,
                   paid INTEGER DEFAULT 0,
                   attendees TEXT DEFAULT '[]',
+                  attendee_count INTEGER NOT NULL DEFAULT 0,
                   payment_amount REAL DEFAULT 0,
+                  date_int INTEGER GENERATED ALWAYS AS (CAST(REPLACE(date, '-', '') AS INTEGER)) VIRTUAL,
                   FOREIGN KEY (studio_id) REFERENCES studios(id))''')
     
-    # Create indexes for faster queries
-    c.execute('CREATE INDEX IF NOT EXISTS idx_studios_user ON studios(user_id)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON training_sessions(user_id)')
+    # Version counters for in-process caches and ETags, bumped by triggers so every worker sees writes
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions
+                 (name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0)''')
+    for name, table in (('studios', 'studios'), ('sessions', 'training_sessions')):
+        c.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES (?)", (name,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{name}_{event.lower()}_version
+                          AFTER {event} ON {table}
+                          BEGIN
+                              UPDATE cache_versions SET version = version + 1 WHERE name = '{name}';
+                          END''')
+    
+    # Read the current columns once and only migrate what is missing
+    studio_cols = {row[1] for row in c.execute("PRAGMA table_info(studios)")}
+    # table_xinfo also lists generated columns
+    session_cols = {row[1] for row in c.execute("PRAGMA table_xinfo(training_sessions)")}
     
     # Migration: Add user_id to existing tables if not present
-    try:
-        c.execute("SELECT user_id FROM studios LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, need to migrate
+    if 'user_id' not in studio_cols:
         print("Migrating database: adding user_id to studios...")
         c.execute("ALTER TABLE studios ADD COLUMN user_id TEXT DEFAULT 'legacy_user'")
         c.execute("UPDATE studios SET user_id = 'legacy_user' WHERE user_id IS NULL")
         print("Migration complete for studios!")
     
-    try:
-        c.execute("SELECT user_id FROM training_sessions LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, need to migrate
+    if 'user_id' not in session_cols:
         print("Migrating database: adding user_id to training_sessions...")
         c.execute("ALTER TABLE training_sessions ADD COLUMN user_id TEXT DEFAULT 'legacy_user'")
         c.execute("UPDATE training_sessions SET user_id = 'legacy_user' WHERE user_id IS NULL")
         print("Migration complete for training_sessions!")
     
     # Migration: Add payment_individual to existing studios if not present
-    try:
-        c.execute("SELECT payment_individual FROM studios LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, need to migrate
+    if 'payment_individual' not in studio_cols:
         print("Migrating database: adding payment_individual to studios...")
         c.execute("ALTER TABLE studios ADD COLUMN payment_individual REAL DEFAULT 0")
         print("Migration complete for payment_individual!")
     
-    conn.commit()
-    conn.close()
+    # Migration: Add attendee_count to existing sessions if not present
+    if 'attendee_count' not in session_cols:
+        print("Migrating database: adding attendee_count to training_sessions...")
+        c.execute("ALTER TABLE training_sessions ADD COLUMN attendee_count INTEGER NOT NULL DEFAULT 0")
+        c.execute("UPDATE training_sessions SET attendee_count = COALESCE(json_array_length(attendees), 0)")
+        print("Migration complete for attendee_count!")
+    
+    # Migration: Add payment_amount, which the payment triggers below keep in sync
+    if 'payment_amount' not in session_cols:
+        print("Migrating database: adding payment_amount to training_sessions...")
+        c.execute("ALTER TABLE training_sessions ADD COLUMN payment_amount REAL DEFAULT 0")
+        print("Migration complete for payment_amount!")
+    
+    # Migration: Add date_int (YYYYMMDD) for integer date range filters.
+    # Only VIRTUAL generated columns can be added to an existing table; the index stores the value.
+    if 'date_int' not in session_cols:
+        print("Migrating database: adding date_int to training_sessions...")
+        c.execute("ALTER TABLE training_sessions ADD COLUMN date_int INTEGER "
+                  "GENERATED ALWAYS AS (CAST(REPLACE(date, '-', '') AS INTEGER)) VIRTUAL")
+        print("Migration complete for date_int!")
+    
+    # Create indexes for faster queries (after migrations, since they need user_id)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_studios_user ON studios(user_id)')
+    # Also yields a user's sessions in rowid order, so GET /api/sessions' ORDER BY id needs no sort
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user ON training_sessions(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_studio ON training_sessions(studio_id)')
+    # Per-user studio and date filters; the date filters no longer use the older date indexes
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_studio ON training_sessions(user_id, studio_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_date_int ON training_sessions(user_id, date_int)')
+    c.execute('DROP INDEX IF EXISTS idx_sessions_user_date')
+    c.execute('DROP INDEX IF EXISTS idx_sessions_date_studio')
+    
+    # Keep training_sessions.payment_amount in sync with calculate_payment() so reads can sum it.
+    # Backfill once when the triggers are first installed.
+    has_payment_triggers = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_sessions_payment_insert'").fetchone()
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_sessions_payment_insert
+                  AFTER INSERT ON training_sessions
+                  BEGIN
+                      UPDATE training_sessions SET payment_amount = {STORED_PAYMENT_SQL} WHERE id = NEW.id;
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_sessions_payment_update
+                  AFTER UPDATE OF studio_id, attendee_count ON training_sessions
+                  BEGIN
+                      UPDATE training_sessions SET payment_amount = {STORED_PAYMENT_SQL} WHERE id = NEW.id;
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_studios_payment_update
+                  AFTER UPDATE OF payment_per_client, minimum_payment, start_count_from ON studios
+                  BEGIN
+                      UPDATE training_sessions SET payment_amount = {STORED_PAYMENT_SQL} WHERE studio_id = NEW.id;
+                  END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_studios_payment_delete
+                  AFTER DELETE ON studios
+                  BEGIN
+                      UPDATE training_sessions SET payment_amount = 0 WHERE studio_id = OLD.id;
+                  END''')
+    if not has_payment_triggers:
+        c.execute(f'UPDATE training_sessions SET payment_amount = {STORED_PAYMENT_SQL}')
 
 # Initialize database on startup
 init_db()
 
+# Queries are kept as module constants so each connection's statement cache
+# sees the same SQL text on every request
+SQL_GET_CACHE_VERSION = 'SELECT version FROM cache_versions WHERE name = ?'
+
+# Only what calculate_payment() needs, and only if the studio belongs to the user
+SQL_GET_USER_STUDIO = '''
+    SELECT minimum_payment, start_count_from, payment_per_client
+    FROM studios
+    WHERE id = ? AND user_id = ?
+'''
+
+SQL_STUDIO_EXISTS = 'SELECT 1 FROM studios WHERE id = ? AND user_id = ?'
+
+SQL_INSERT_STUDIO = '''
+    INSERT INTO studios (user_id, name, payment_per_client, minimum_payment, start_count_from, payment_individual, color)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+SQL_UPDATE_STUDIO = '''
+    UPDATE studios
+    SET name = ?, payment_per_client = ?, minimum_payment = ?, start_count_from = ?, payment_individual = ?, color = ?
+    WHERE id = ? AND user_id = ?
+'''
+
+SQL_DELETE_UNUSED_STUDIO = '''
+    DELETE FROM studios WHERE id = ? AND user_id = ?
+    AND NOT EXISTS (SELECT 1 FROM training_sessions WHERE studio_id = ? AND user_id = ?)
+'''
+
+SQL_COUNT_STUDIO_SESSIONS = 'SELECT COUNT(*) FROM training_sessions WHERE studio_id = ? AND user_id = ?'
+
+SQL_INSERT_SESSION = '''
+    INSERT INTO training_sessions
+    (user_id, studio_id, date, time, duration, capacity, coach_name, session_type, paid, attendees)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, '[]')
+'''
+
+SQL_DELETE_SESSION = 'DELETE FROM training_sessions WHERE id = ? AND user_id = ?'
+
+SQL_MARK_SESSION_PAID = 'UPDATE training_sessions SET paid = 1 WHERE id = ? AND user_id = ?'
+
+SQL_GET_STUDIOS = '''
+    SELECT id, name, payment_per_client, minimum_payment, start_count_from, payment_individual, color
+    FROM studios
+    WHERE user_id = ?
+'''
+
+SQL_GET_SESSIONS = '''
+    SELECT id, studio_id, date, time, duration, capacity, coach_name,
+           session_type, paid, attendees, payment_amount
+    FROM training_sessions
+    WHERE user_id = ?
+    ORDER BY id
+'''
+
+# Per-session rows for filtered stats, newest first; {where} filters training_sessions aliased as ts
+SESSION_PAYMENTS_SQL = '''
+    SELECT ts.id, ts.date, ts.time, ts.capacity, ts.coach_name, ts.session_type, ts.paid,
+           ts.attendee_count, st.name AS studio_name, ts.payment_amount
+    FROM training_sessions ts
+    LEFT JOIN studios st ON st.id = ts.studio_id AND st.user_id = ts.user_id
+    WHERE {where}
+    ORDER BY ts.date DESC, ts.time DESC
+'''
+
+SESSION_STATS_SQL = '''
+    SELECT COUNT(*) AS total_sessions,
+           COALESCE(SUM(attendee_count), 0) AS total_attendees,
+           COALESCE(SUM(CASE WHEN paid THEN payment_amount ELSE 0 END), 0) AS paid_revenue,
+           COALESCE(SUM(CASE WHEN paid THEN 0 ELSE payment_amount END), 0) AS pending_revenue,
+           COALESCE(SUM(LOWER(session_type) = 'group'), 0) AS group_sessions,
+           COALESCE(SUM(LOWER(session_type) != 'group'), 0) AS individual_sessions
+    FROM training_sessions ts
+    WHERE {where}
+'''
+
+SQL_GET_STATS = SESSION_STATS_SQL.format(where='ts.user_id = ?')
+
+# Returns the updated row with its payment worked out against the owner's studio
+SQL_UPDATE_SESSION = '''
+    UPDATE training_sessions
+    SET studio_id = ?, date = ?, time = ?, duration = ?,
+        capacity = ?, coach_name = ?, session_type = ?
+    WHERE id = ? AND user_id = ?
+    RETURNING id, studio_id, date, time, duration, capacity, coach_name, session_type, paid, attendees,
+              ''' + STORED_PAYMENT_SQL + ''' AS payment
+'''
+
+# Attendee changes happen inside SQLite. Capacity and membership are checked in the same
+# statement, so there is no gap between reading the list and writing it back. The row is
+# always returned (unchanged if the add/remove did not apply); no row means no such session.
+SQL_ADD_ATTENDEE = '''
+    UPDATE training_sessions
+    SET attendees = CASE WHEN attendee_count < capacity
+                              AND NOT EXISTS (SELECT 1 FROM json_each(attendees) WHERE value = :name)
+                         THEN json_insert(attendees, '$[#]', :name)
+                         ELSE attendees END,
+        attendee_count = attendee_count + (attendee_count < capacity
+                                           AND NOT EXISTS (SELECT 1 FROM json_each(attendees) WHERE value = :name))
+    WHERE id = :session_id AND user_id = :user_id
+    RETURNING attendees, ''' + STORED_PAYMENT_SQL + ''' AS payment
+'''
+
+SQL_REMOVE_ATTENDEE = '''
+    UPDATE training_sessions
+    SET attendees = COALESCE(json_remove(attendees, (SELECT '$[' || key || ']' FROM json_each(attendees)
+                                                     WHERE value = :name ORDER BY key LIMIT 1)),
+                             attendees),
+        attendee_count = attendee_count - EXISTS (SELECT 1 FROM json_each(attendees) WHERE value = :name)
+    WHERE id = :session_id AND user_id = :user_id
+    RETURNING attendees, ''' + STORED_PAYMENT_SQL + ''' AS payment
+'''
+
 # Helper functions
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+def _new_conn():
+    # Pooled connections move between worker threads, but only one request uses them at a time.
+    # Autocommit mode: reads run without a transaction, write handlers issue BEGIN IMMEDIATE.
+    # A larger statement cache keeps every query in this module prepared.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def get_db():
+    """
+    Check a connection out of the pool for the current request.
+    Repeated calls within one request reuse the same connection.
+    """
+    conn = g.get('db')
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _new_conn()
+        g.db = conn
+    return conn
+
+@app.teardown_request
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        return_db(conn)
+
+def return_db(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@atexit.register
+def close_db_pool():
+    """
+    Let SQLite refresh index statistics, then close pooled connections on shutdown
+    """
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        conn.execute('PRAGMA optimize')
+        conn.close()
+
+def get_cache_version(conn, name):
+    return conn.execute(SQL_GET_CACHE_VERSION, (name,)).fetchone()[0]
+
+def make_etag(user_id, *versions):
+    """
+    ETag for one user's view of data covered by the given cache_versions counters.
+    A full SHA-256 of the user id keeps tags from different users apart.
+    """
+    return '-'.join(map(str, versions)) + '-' + hashlib.sha256(user_id.encode()).hexdigest()
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.vary.update(USER_VARY_HEADERS)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+def json_response(payload, etag=None):
+    """
+    Serialize with orjson straight to bytes instead of going through jsonify;
+    bytes are sent as they are
+    """
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    response = Response(body, mimetype='application/json')
+    response.vary.update(USER_VARY_HEADERS)
+    if etag:
+        # Clients must revalidate, so a 304 is only sent while the data is unchanged
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+    return response
+
+def stream_json_array(items, prefix=b'[', suffix=b']', chunk_size=65536):
+    """
+    Serialize items one at a time into a JSON array, yielding ~chunk_size byte chunks.
+    prefix/suffix allow the array to close out a larger object.
+    """
+    buf = bytearray(prefix)
+    sep = b''
+    for item in items:
+        buf += sep
+        buf += orjson.dumps(item)
+        sep = b','
+        if len(buf) >= chunk_size:
+            yield bytes(buf)
+            buf.clear()
+    buf += suffix
+    yield bytes(buf)
+
+def stream_response(chunks):
+    """
+    Stream chunks read from this request's pooled connection.
+    Teardown runs before the server sends the body, so the connection is taken
+    off flask.g here and only goes back to the pool once the response is closed.
+    """
+    response = Response(chunks, mimetype='application/json')
+    response.vary.update(USER_VARY_HEADERS)
+    response.call_on_close(functools.partial(return_db, g.pop('db')))
+    return response
+
+def date_to_int(date_str):
+    """
+    'YYYY-MM-DD' -> YYYYMMDD, the same value as the date_int column.
+    Raises ValueError if date_str is not a valid date.
+    """
+    d = datetime.date.fromisoformat(date_str)
+    return d.year * 10000 + d.month * 100 + d.day
+
 def calculate_payment(attendee_count, studio_dict):
     if not studio_dict:
         return 0
@@ -130,33 +517,48 @@ def index():
 # Studio API - All filtered by user_id
 @app.route('/api/studios', methods=['GET'])
 def get_studios():
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
-    studios = conn.execute('SELECT * FROM studios WHERE user_id = ?', (user_id,)).fetchall()
-    conn.close()
-    return jsonify([{
-        'id': s['id'],
-        'name': s['name'],
-        'paymentPerClient': s['payment_per_client'],
-        'minimumPayment': s['minimum_payment'],
-        'startCountFrom': s['start_count_from'],
-        'paymentIndividual': s['payment_individual'],
-        'color': s['color']
-    } for s in studios])
+    version = get_cache_version(conn, 'studios')
+    etag = make_etag(user_id, version)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    
+    cached = _studios_response_cache.get(user_id)
+    if cached and cached[0] == version:
+        _studios_response_cache.move_to_end(user_id)
+        return json_response(cached[1], etag)
+    
+    cur = conn.cursor()
+    cur.row_factory = None
+    body = orjson.dumps([{
+        'id': id_,
+        'name': name,
+        'paymentPerClient': payment_per_client,
+        'minimumPayment': minimum_payment,
+        'startCountFrom': start_count_from,
+        'paymentIndividual': payment_individual,
+        'color': color
+    } for (id_, name, payment_per_client, minimum_payment, start_count_from, payment_individual, color)
+        in cur.execute(SQL_GET_STUDIOS, (user_id,))])
+    _studios_response_cache[user_id] = (version, body)
+    _studios_response_cache.move_to_end(user_id)
+    if len(_studios_response_cache) > STUDIOS_RESPONSE_CACHE_SIZE:
+        _studios_response_cache.popitem(last=False)
+    return json_response(body, etag)
 
 @app.route('/api/studios', methods=['POST'])
 def add_studio():
-    user_id = get_user_id()
+    user_id = g.user_id
     data = request.json
     conn = get_db()
     c = conn.cursor()
-    c.execute('''INSERT INTO studios (user_id, name, payment_per_client, minimum_payment, start_count_from, payment_individual, color) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
+    conn.execute('BEGIN IMMEDIATE')
+    c.execute(SQL_INSERT_STUDIO,
               (user_id, data['name'], data['paymentPerClient'], data['minimumPayment'], 
                data['startCountFrom'], data.get('paymentIndividual', 0), data.get('color', '#FF6B6B')))
     studio_id = c.lastrowid
     conn.commit()
-    conn.close()
     return jsonify({
         'id': studio_id,
         'name': data['name'],
@@ -169,51 +571,40 @@ def add_studio():
 
 @app.route('/api/studios/<int:studio_id>', methods=['DELETE'])
 def delete_studio(studio_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
     c = conn.cursor()
-    
-    # Check if studio exists AND belongs to this user
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', (studio_id, user_id)).fetchone()
-    if not studio:
-        conn.close()
-        return jsonify({'error': 'Studio not found'}), 404
-    
-    # Check if studio has any sessions
-    sessions = conn.execute('SELECT COUNT(*) FROM training_sessions WHERE studio_id = ? AND user_id = ?', 
-                          (studio_id, user_id)).fetchone()[0]
-    if sessions > 0:
-        conn.close()
+    conn.execute('BEGIN IMMEDIATE')
+    
+    # Delete the studio only if it belongs to this user and has no sessions
+    c.execute(SQL_DELETE_UNUSED_STUDIO, (studio_id, user_id, studio_id, user_id))
+    if c.rowcount == 0:
+        # Nothing deleted: work out why
+        studio = conn.execute(SQL_STUDIO_EXISTS, (studio_id, user_id)).fetchone()
+        if not studio:
+            return jsonify({'error': 'Studio not found'}), 404
+        
+        sessions = conn.execute(SQL_COUNT_STUDIO_SESSIONS, (studio_id, user_id)).fetchone()[0]
         return jsonify({'error': f'Cannot delete studio. It has {sessions} training session(s) associated with it.'}), 400
-    
-    # Delete the studio
-    c.execute('DELETE FROM studios WHERE id = ? AND user_id = ?', (studio_id, user_id))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'message': 'Studio deleted successfully'})
 
 @app.route('/api/studios/<int:studio_id>', methods=['PUT'])
 def update_studio(studio_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     data = request.json
     conn = get_db()
     c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    # Check if studio exists AND belongs to this user
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', (studio_id, user_id)).fetchone()
-    if not studio:
-        conn.close()
-        return jsonify({'error': 'Studio not found'}), 404
-    
-    # Update the studio
-    c.execute('''UPDATE studios 
-                 SET name = ?, payment_per_client = ?, minimum_payment = ?, start_count_from = ?, payment_individual = ?, color = ?
-                 WHERE id = ? AND user_id = ?''',
+    # Update the studio; no matched row means it doesn't exist or belongs to another user
+    c.execute(SQL_UPDATE_STUDIO,
               (data['name'], data['paymentPerClient'], data['minimumPayment'], 
                data['startCountFrom'], data.get('paymentIndividual', 0), data['color'], studio_id, user_id))
+    if c.rowcount == 0:
+        return jsonify({'error': 'Studio not found'}), 404
     conn.commit()
-    conn.close()
     
     return jsonify({
         'id': studio_id,
@@ -228,128 +619,95 @@ def update_studio(studio_id):
 # Training Session API - All filtered by user_id
 @app.route('/api/sessions', methods=['GET'])
 def get_sessions():
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
-    sessions = conn.execute('SELECT * FROM training_sessions WHERE user_id = ?', (user_id,)).fetchall()
-    studios = {s['id']: s for s in conn.execute('SELECT * FROM studios WHERE user_id = ?', (user_id,)).fetchall()}
-    
-    result = []
-    for s in sessions:
-        studio = studios.get(s['studio_id'])
-        attendees = json.loads(s['attendees']) if s['attendees'] else []
-        payment = calculate_payment(len(attendees), studio) if studio else 0
-        
-        result.append({
-            'id': s['id'],
-            'studioId': s['studio_id'],
-            'date': s['date'],
-            'time': s['time'],
-            'duration': s['duration'],
-            'capacity': s['capacity'],
-            'coachName': s['coach_name'],
-            'sessionType': s['session_type'],
-            'paid': bool(s['paid']),
-            'attendees': attendees,
-            'payment': payment
-        })
-    
-    conn.close()
-    return jsonify(result)
+    # Plain tuples are cheaper to unpack than sqlite3.Row key lookups on this hot path
+    cur = conn.cursor()
+    cur.row_factory = None
+    
+    # Rows are serialized as they are read, so the full list is never built
+    return stream_response(stream_json_array({
+        'id': id_,
+        'studioId': studio_id,
+        'date': date_,
+        'time': time_,
+        'duration': duration,
+        'capacity': capacity,
+        'coachName': coach_name,
+        'sessionType': session_type,
+        'paid': bool(paid),
+        'attendees': orjson.loads(attendees_json) if attendees_json else [],
+        'payment': payment
+    } for (id_, studio_id, date_, time_, duration, capacity, coach_name, session_type,
+           paid, attendees_json, payment) in cur.execute(SQL_GET_SESSIONS, (user_id,))))
 
 @app.route('/api/sessions', methods=['POST'])
 def add_session():
-    user_id = get_user_id()
+    user_id = g.user_id
     data = request.json
     conn = get_db()
     c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
     # Verify studio belongs to user
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', 
-                         (data['studioId'], user_id)).fetchone()
+    studio = conn.execute(SQL_GET_USER_STUDIO, (data['studioId'], user_id)).fetchone()
     if not studio:
-        conn.close()
         return jsonify({'error': 'Studio not found'}), 404
     
-    c.execute('''INSERT INTO training_sessions 
-                 (user_id, studio_id, date, time, duration, capacity, coach_name, session_type, paid, attendees)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, '[]')''',
+    c.execute(SQL_INSERT_SESSION,
               (user_id, data['studioId'], data['date'], data['time'], data['duration'],
                data['capacity'], data['coachName'], data['sessionType']))
     session_id = c.lastrowid
     conn.commit()
     
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    conn.close()
-    
-    payment = calculate_payment(0, studio)
-    
+    # Everything else in the new row came from the request, so don't read it back
     return jsonify({
-        'id': session['id'],
-        'studioId': session['studio_id'],
-        'date': session['date'],
-        'time': session['time'],
-        'duration': session['duration'],
-        'capacity': session['capacity'],
-        'coachName': session['coach_name'],
-        'sessionType': session['session_type'],
-        'paid': bool(session['paid']),
+        'id': session_id,
+        'studioId': data['studioId'],
+        'date': data['date'],
+        'time': data['time'],
+        'duration': data['duration'],
+        'capacity': data['capacity'],
+        'coachName': data['coachName'],
+        'sessionType': data['sessionType'],
+        'paid': False,
         'attendees': [],
-        'payment': payment
+        'payment': calculate_payment(0, studio)
     })
 
 @app.route('/api/sessions/<int:session_id>', methods=['DELETE'])
 def delete_session(session_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
     c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    # Check if session exists AND belongs to this user
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    if not session:
-        conn.close()
+    # Delete the session; no matched row means it doesn't exist or belongs to another user
+    c.execute(SQL_DELETE_SESSION, (session_id, user_id))
+    if c.rowcount == 0:
         return jsonify({'error': 'Session not found'}), 404
-    
-    # Delete the session
-    c.execute('DELETE FROM training_sessions WHERE id = ? AND user_id = ?', (session_id, user_id))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True, 'message': 'Session deleted successfully'})
 
 @app.route('/api/sessions/<int:session_id>', methods=['PUT'])
 def update_session(session_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     data = request.json
     conn = get_db()
     c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    # Check if session exists AND belongs to this user
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
+    # Update the session and get the new row back; none means it doesn't exist or belongs to another user
+    session = c.execute(SQL_UPDATE_SESSION,
+                        (data['studioId'], data['date'], data['time'], data['duration'],
+                         data['capacity'], data['coachName'], data['sessionType'], 
+                         session_id, user_id)).fetchone()
     if not session:
-        conn.close()
         return jsonify({'error': 'Session not found'}), 404
-    
-    # Update the session
-    c.execute('''UPDATE training_sessions 
-                 SET studio_id = ?, date = ?, time = ?, duration = ?, 
-                     capacity = ?, coach_name = ?, session_type = ?
-                 WHERE id = ? AND user_id = ?''',
-              (data['studioId'], data['date'], data['time'], data['duration'],
-               data['capacity'], data['coachName'], data['sessionType'], 
-               session_id, user_id))
     conn.commit()
     
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', 
-                         (session['studio_id'], user_id)).fetchone()
-    conn.close()
-    
-    attendees = json.loads(session['attendees']) if session['attendees'] else []
-    payment = calculate_payment(len(attendees), studio) if studio else 0
+    attendees = orjson.loads(session['attendees']) if session['attendees'] else []
     
     return jsonify({
         'id': session['id'],
@@ -362,209 +720,145 @@ def update_session(session_id):
         'sessionType': session['session_type'],
         'paid': bool(session['paid']),
         'attendees': attendees,
-        'payment': payment
+        'payment': session['payment']
     })
 
 @app.route('/api/sessions/<int:session_id>/attendees', methods=['POST'])
 def add_attendee(session_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     data = request.json
     conn = get_db()
-    c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
+    session = conn.execute(SQL_ADD_ATTENDEE,
+                           {'name': data['name'], 'session_id': session_id, 'user_id': user_id}).fetchone()
+    conn.commit()
     if not session:
-        conn.close()
         return jsonify({'error': 'Session not found'}), 404
     
-    attendees = json.loads(session['attendees']) if session['attendees'] else []
-    if data['name'] not in attendees and len(attendees) < session['capacity']:
-        attendees.append(data['name'])
-        c.execute('UPDATE training_sessions SET attendees = ? WHERE id = ? AND user_id = ?',
-                 (json.dumps(attendees), session_id, user_id))
-        conn.commit()
-    
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', 
-                         (session['studio_id'], user_id)).fetchone()
-    conn.close()
-    
-    attendees = json.loads(session['attendees']) if session['attendees'] else []
-    payment = calculate_payment(len(attendees), studio) if studio else 0
+    attendees = orjson.loads(session['attendees']) if session['attendees'] else []
     
     return jsonify({
         'attendees': attendees,
-        'payment': payment
+        'payment': session['payment']
     })
 
 @app.route('/api/sessions/<int:session_id>/attendees/<attendee_name>', methods=['DELETE'])
 def remove_attendee(session_id, attendee_name):
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
-    c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
+    session = conn.execute(SQL_REMOVE_ATTENDEE,
+                           {'name': attendee_name, 'session_id': session_id, 'user_id': user_id}).fetchone()
+    conn.commit()
     if not session:
-        conn.close()
         return jsonify({'error': 'Session not found'}), 404
     
-    attendees = json.loads(session['attendees']) if session['attendees'] else []
-    if attendee_name in attendees:
-        attendees.remove(attendee_name)
-        c.execute('UPDATE training_sessions SET attendees = ? WHERE id = ? AND user_id = ?',
-                 (json.dumps(attendees), session_id, user_id))
-        conn.commit()
-    
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    studio = conn.execute('SELECT * FROM studios WHERE id = ? AND user_id = ?', 
-                         (session['studio_id'], user_id)).fetchone()
-    conn.close()
-    
-    attendees = json.loads(session['attendees']) if session['attendees'] else []
-    payment = calculate_payment(len(attendees), studio) if studio else 0
+    attendees = orjson.loads(session['attendees']) if session['attendees'] else []
     
     return jsonify({
         'attendees': attendees,
-        'payment': payment
+        'payment': session['payment']
     })
 
 @app.route('/api/sessions/<int:session_id>/mark-paid', methods=['PUT'])
 def mark_session_paid(session_id):
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
     c = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
     
-    # Check if session exists AND belongs to this user
-    session = conn.execute('SELECT * FROM training_sessions WHERE id = ? AND user_id = ?', 
-                          (session_id, user_id)).fetchone()
-    if not session:
-        conn.close()
+    c.execute(SQL_MARK_SESSION_PAID, (session_id, user_id))
+    if c.rowcount == 0:
         return jsonify({'error': 'Session not found'}), 404
-    
-    c.execute('UPDATE training_sessions SET paid = 1 WHERE id = ? AND user_id = ?', 
-             (session_id, user_id))
     conn.commit()
-    conn.close()
     return jsonify({'success': True})
 
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
-    user_id = get_user_id()
+    user_id = g.user_id
     conn = get_db()
-    sessions = conn.execute('SELECT * FROM training_sessions WHERE user_id = ?', (user_id,)).fetchall()
-    studios = {s['id']: s for s in conn.execute('SELECT * FROM studios WHERE user_id = ?', (user_id,)).fetchall()}
-    
-    total_sessions = len(sessions)
-    total_attendees = 0
-    paid_revenue = 0
-    pending_revenue = 0
-    
-    for s in sessions:
-        studio = studios.get(s['studio_id'])
-        attendees = json.loads(s['attendees']) if s['attendees'] else []
-        total_attendees += len(attendees)
-        payment = calculate_payment(len(attendees), studio) if studio else 0
-        
-        if s['paid']:
-            paid_revenue += payment
-        else:
-            pending_revenue += payment
-    
-    conn.close()
-    
-    return jsonify({
-        'totalSessions': total_sessions,
-        'totalAttendees': total_attendees,
-        'paidRevenue': paid_revenue,
-        'pendingRevenue': pending_revenue
-    })
+    etag = make_etag(user_id, get_cache_version(conn, 'studios'), get_cache_version(conn, 'sessions'))
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    
+    stats = conn.execute(SQL_GET_STATS, (user_id,)).fetchone()
+    
+    return json_response({
+        'totalSessions': stats['total_sessions'],
+        'totalAttendees': stats['total_attendees'],
+        'paidRevenue': stats['paid_revenue'],
+        'pendingRevenue': stats['pending_revenue']
+    }, etag)
 
 @app.route('/api/stats/filtered', methods=['GET'])
 def get_filtered_stats():
-    user_id = get_user_id()
+    user_id = g.user_id
     studio_id = request.args.get('studioId')
     date_from = request.args.get('dateFrom')
     date_to = request.args.get('dateTo')
+    try:
+        date_from = date_to_int(date_from) if date_from else None
+        date_to = date_to_int(date_to) if date_to else None
+    except ValueError:
+        return jsonify({'error': 'dateFrom and dateTo must be dates in YYYY-MM-DD format'}), 400
     
     conn = get_db()
     
-    # Build query with filters
-    query = 'SELECT * FROM training_sessions WHERE user_id = ?'
+    # Build filters
+    where = 'ts.user_id = ?'
     params = [user_id]
     
     if studio_id and studio_id != 'all':
-        query += ' AND studio_id = ?'
+        where += ' AND ts.studio_id = ?'
         params.append(int(studio_id))
     
-    if date_from:
-        query += ' AND date >= ?'
+    if date_from is not None:
+        where += ' AND ts.date_int >= ?'
         params.append(date_from)
     
-    if date_to:
-        query += ' AND date <= ?'
+    if date_to is not None:
+        where += ' AND ts.date_int <= ?'
         params.append(date_to)
     
-    sessions = conn.execute(query, params).fetchall()
-    studios = {s['id']: s for s in conn.execute('SELECT * FROM studios WHERE user_id = ?', (user_id,)).fetchall()}
-    
-    total_sessions = len(sessions)
-    total_attendees = 0
-    paid_revenue = 0
-    pending_revenue = 0
-    group_sessions = 0
-    individual_sessions = 0
-    detailed_sessions = []
-    
-    for s in sessions:
-        studio = studios.get(s['studio_id'])
-        attendees = json.loads(s['attendees']) if s['attendees'] else []
-        attendee_count = len(attendees)
-        total_attendees += attendee_count
-        payment = calculate_payment(attendee_count, studio) if studio else 0
-        
-        if s['session_type'].lower() == 'group':
-            group_sessions += 1
-        else:
-            individual_sessions += 1
-        
-        if s['paid']:
-            paid_revenue += payment
-        else:
-            pending_revenue += payment
-        
-        detailed_sessions.append({
-            'id': s['id'],
-            'date': s['date'],
-            'time': s['time'],
-            'studioName': studio['name'] if studio else 'Unknown',
-            'coachName': s['coach_name'],
-            'sessionType': s['session_type'],
+    stats = conn.execute(SESSION_STATS_SQL.format(where=where), params).fetchone()
+    result = {
+        'totalSessions': stats['total_sessions'],
+        'totalAttendees': stats['total_attendees'],
+        'paidRevenue': stats['paid_revenue'],
+        'pendingRevenue': stats['pending_revenue'],
+        'groupSessions': stats['group_sessions'],
+        'individualSessions': stats['individual_sessions']
+    }
+    
+    # The per-session list is only built when the client asks for it,
+    # and then streamed after the totals as the last key of the object
+    if request.args.get('detail') == '1':
+        cur = conn.cursor()
+        cur.row_factory = None
+        sessions = ({
+            'id': id_,
+            'date': date_,
+            'time': time_,
+            'studioName': studio_name if studio_name is not None else 'Unknown',
+            'coachName': coach_name,
+            'sessionType': session_type,
             'attendees': attendee_count,
-            'capacity': s['capacity'],
+            'capacity': capacity,
             'payment': payment,
-            'paid': bool(s['paid'])
-        })
+            'paid': bool(paid)
+        } for (id_, date_, time_, capacity, coach_name, session_type, paid,
+               attendee_count, studio_name, payment) in cur.execute(SESSION_PAYMENTS_SQL.format(where=where), params))
+        return stream_response(stream_json_array(
+            sessions, prefix=orjson.dumps(result)[:-1] + b',"sessions":[', suffix=b']}'))
     
-    conn.close()
-    
-    return jsonify({
-        'totalSessions': total_sessions,
-        'totalAttendees': total_attendees,
-        'paidRevenue': paid_revenue,
-        'pendingRevenue': pending_revenue,
-        'groupSessions': group_sessions,
-        'individualSessions': individual_sessions,
-        'sessions': detailed_sessions
-    })
+    return json_response(result)
 
 # User info endpoint (for testing)
 @app.route('/api/user-info', methods=['GET'])
 def get_user_info():
-    user_id = get_user_id()
+    user_id = g.user_id
     return jsonify({
         'userId': user_id,
         'userType': 'telegram' if user_id.startswith('tg_') else 'web'
@@ -573,4 +867,13 @@ def get_user_info():
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('DEBUG', 'False').lower() == 'true'
+    if not debug:
+        # Same server as the Procfile; keep-alive lets the page's back-to-back API calls share a connection
+        workers = os.environ.get('WEB_CONCURRENCY', str((os.cpu_count() or 1) * 2 + 1))
+        try:
+            os.execvp('gunicorn', ['gunicorn', 'app_with_statistics:app',
+                                   '--worker-class', 'gevent', '--workers', workers,
+                                   '--keep-alive', '30', '--bind', f'0.0.0.0:{port}'])
+        except FileNotFoundError:
+            print("gunicorn not found, falling back to the Flask development server")
     app.run(debug=debug, host='0.0.0.0', port=port)